@@ -0,0 +1,13 @@
+-- ============================================================================
+-- Migration 002: Índice composto cobrindo consultas por período + situação
+-- Projeto Sol - Coleta de dados Bling v3
+-- ============================================================================
+
+-- Consultas do tipo "NF-es no período com situação X" passam a usar
+-- index-only scan (sem heap fetch) graças às colunas INCLUDE.
+CREATE INDEX IF NOT EXISTS ix_nfe_data_situacao
+    ON nfe_cabecalho (data_emissao, situacao)
+    INCLUDE (id, total_nota, contato_id);
+
+-- Atualizar o visibility map para habilitar index-only scans de imediato
+VACUUM ANALYZE nfe_cabecalho;
@@ -0,0 +1,9 @@
+-- ============================================================================
+-- Migration 003: oauth_tokens sem WAL
+-- Projeto Sol - Coleta de dados Bling v3
+-- ============================================================================
+
+-- A tabela tem exatamente 1 linha, reescrita a cada refresh de token.
+-- Sem WAL a escrita vira página em memória + flush em background; se o
+-- servidor cair, basta reautorizar via first_auth.py.
+ALTER TABLE oauth_tokens SET UNLOGGED;
@@ -0,0 +1,18 @@
+-- ============================================================================
+-- Migration 004: exclusividade de execução em andamento
+-- Projeto Sol - Coleta de dados Bling v3
+-- ============================================================================
+
+-- No máximo uma linha com status=running: fecha a corrida entre a checagem
+-- de ocupado do /run e o INSERT quando dois POSTs chegam ao mesmo tempo.
+-- Se já houver mais de uma linha running (órfãs de processos mortos),
+-- marcá-las como error antes de criar o índice.
+UPDATE etl_controle
+   SET status = 'error',
+       fim = NOW(),
+       erro_mensagem = 'Execução órfã: processo encerrado sem finalizar'
+ WHERE status = 'running';
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_etl_controle_running
+    ON etl_controle (status)
+    WHERE status = 'running';
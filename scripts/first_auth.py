@@ -18,7 +18,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from src.config import get_settings
-from src.db.database import Base, SessionLocal, engine
+from src.db.database import SessionLocal, init_schema
 from src.auth.oauth import exchange_authorization_code
 
 # ── Estado global ────────────────────────────────────────────────────────────
@@ -72,9 +72,9 @@ def main():
         print("  SOL - Primeira autorização OAuth Bling v3")
         print("=" * 60)
         print()
-        print("[1/5] Criando tabelas no banco...")
-        Base.metadata.create_all(bind=engine)
-        print("       Tabelas criadas.")
+        print("[1/5] Verificando tabelas no banco...")
+        init_schema()
+        print("       Tabelas prontas.")
 
         # b) Iniciar servidor local
         print("[2/5] Iniciando servidor local na porta 8000...")
@@ -1,8 +1,13 @@
+import asyncio
 import logging
+import threading
 import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Self
 
 import httpx
+import orjson
 from tenacity import (
     before_sleep_log,
     retry,
@@ -20,20 +25,42 @@ class BlingRateLimitError(Exception):
     """Erro de rate limit da API Bling (429)."""
 
 
+MAX_CONCURRENCY = 3
+
+
 class BlingClient:
     def __init__(self, access_token: str) -> None:
         settings = get_settings()
+        self._access_token = access_token
         self._base_url = settings.BLING_API_BASE_URL
         self._delay = settings.API_RATE_LIMIT_DELAY
         self._page_size = settings.API_PAGE_SIZE
         self._last_request_time = 0.0
+        self._sync_lock = threading.Lock()
+        self._headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Accept": "application/json",
+        }
+        self._limits = httpx.Limits(
+            max_keepalive_connections=20,
+            max_connections=20,
+            keepalive_expiry=60,
+        )
         self._client = httpx.Client(
             timeout=30,
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json",
-            },
+            headers=self._headers,
+            # retries aqui cobre só falhas de conexão (análogo ao max_retries
+            # do HTTPAdapter); retry de 429 continua com tenacity
+            transport=httpx.HTTPTransport(
+                retries=3, http2=True, limits=self._limits
+            ),
         )
+        # Estado async por event loop: a instância é compartilhada entre
+        # execuções (que podem se sobrepor, cada uma com seu asyncio.run),
+        # e um AsyncClient/Lock criado num loop não pode ser usado noutro
+        self._async_por_loop: dict[
+            asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, asyncio.Lock]
+        ] = {}
 
     # ── Context manager ──────────────────────────────────────────────────
 
@@ -46,13 +73,31 @@ class BlingClient:
     def close(self) -> None:
         self._client.close()
 
+    async def aclose(self) -> None:
+        # Fecha só o client do loop corrente — os de outras execuções
+        # concorrentes continuam vivos
+        estado = self._async_por_loop.pop(asyncio.get_running_loop(), None)
+        if estado is not None:
+            await estado[0].aclose()
+
     # ── Internos ─────────────────────────────────────────────────────────
 
     def _wait_rate_limit(self) -> None:
-        elapsed = time.monotonic() - self._last_request_time
-        if elapsed < self._delay:
-            time.sleep(self._delay - elapsed)
-        self._last_request_time = time.monotonic()
+        # Lock para manter o espaçamento correto com chamadas em threads
+        with self._sync_lock:
+            elapsed = time.monotonic() - self._last_request_time
+            if elapsed < self._delay:
+                time.sleep(self._delay - elapsed)
+            self._last_request_time = time.monotonic()
+
+    @staticmethod
+    def _raise_for_error(path: str, response: httpx.Response) -> None:
+        if response.status_code == 429:
+            logger.warning("Rate limit atingido (429) em %s", path)
+            raise BlingRateLimitError(f"Rate limit em {path}")
+        if response.status_code == 401:
+            raise RuntimeError("Token inválido ou expirado")
+        response.raise_for_status()
 
     @retry(
         retry=retry_if_exception_type(BlingRateLimitError),
@@ -65,19 +110,66 @@ class BlingClient:
         url = f"{self._base_url}/{path}"
         response = self._client.request(method, url, params=params)
 
-        if response.status_code == 429:
-            logger.warning("Rate limit atingido (429) em %s", path)
-            raise BlingRateLimitError(f"Rate limit em {path}")
-
-        if response.status_code == 401:
-            raise RuntimeError("Token inválido ou expirado")
-
-        response.raise_for_status()
-        return response.json()
+        # Caminho feliz: uma única comparação de faixa
+        if response.status_code >= 400:
+            self._raise_for_error(path, response)
+        # orjson parseia payloads grandes (100 KB+) bem mais rápido que o stdlib
+        return orjson.loads(response.content)
 
     def get(self, path: str, params: dict | None = None) -> dict:
         return self._request("GET", path, params)
 
+    # ── Internos (async) ─────────────────────────────────────────────────
+
+    def _estado_async(self) -> tuple[httpx.AsyncClient, asyncio.Lock]:
+        """Client + lock do event loop corrente, criados sob demanda."""
+        loop = asyncio.get_running_loop()
+        estado = self._async_por_loop.get(loop)
+        if estado is None:
+            estado = (
+                httpx.AsyncClient(
+                    timeout=30,
+                    headers=self._headers,
+                    transport=httpx.AsyncHTTPTransport(
+                        retries=3, http2=True, limits=self._limits
+                    ),
+                ),
+                asyncio.Lock(),
+            )
+            self._async_por_loop[loop] = estado
+        return estado
+
+    async def _await_rate_limit(self, lock: asyncio.Lock) -> None:
+        # Serializa o espaçamento entre requisições mesmo com tasks concorrentes
+        async with lock:
+            elapsed = time.monotonic() - self._last_request_time
+            if elapsed < self._delay:
+                await asyncio.sleep(self._delay - elapsed)
+            self._last_request_time = time.monotonic()
+
+    @retry(
+        retry=retry_if_exception_type(BlingRateLimitError),
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=1, min=2, max=30),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+    )
+    async def _request_async(
+        self, method: str, path: str, params: dict | httpx.QueryParams | None = None
+    ) -> dict:
+        client, lock = self._estado_async()
+        await self._await_rate_limit(lock)
+        url = f"{self._base_url}/{path}"
+        response = await client.request(method, url, params=params)
+
+        if response.status_code >= 400:
+            self._raise_for_error(path, response)
+        return orjson.loads(response.content)
+
+    async def get_async(
+        self, path: str, params: dict | httpx.QueryParams | None = None
+    ) -> dict:
+        return await self._request_async("GET", path, params)
+
     # ── NF-e ─────────────────────────────────────────────────────────────
 
     def listar_nfes(
@@ -108,52 +200,208 @@ class BlingClient:
         data_fim: str | None = None,
         situacao: int | None = None,
     ) -> list[dict]:
-        todas = []
+        async def _run() -> list[dict]:
+            try:
+                return await self.listar_todas_nfes_async(
+                    data_inicio=data_inicio,
+                    data_fim=data_fim,
+                    situacao=situacao,
+                )
+            finally:
+                await self.aclose()
+
+        return asyncio.run(_run())
+
+    async def listar_todas_nfes_async(
+        self,
+        data_inicio: str | None = None,
+        data_fim: str | None = None,
+        situacao: int | None = None,
+    ) -> list[dict]:
+        """Pagina o endpoint /nfe buscando janelas de páginas em paralelo.
+
+        A página 1 é buscada sozinha para detectar listagens curtas; depois
+        janelas de MAX_CONCURRENCY páginas são especulativamente buscadas em
+        paralelo até uma página vir incompleta (fim da listagem).
+        """
+        base_params = {
+            "tipo": 1,
+            "limite": self._page_size,
+        }
+        if data_inicio:
+            base_params["dataEmissaoInicial"] = data_inicio
+        if data_fim:
+            base_params["dataEmissaoFinal"] = data_fim
+        if situacao is not None:
+            base_params["situacao"] = situacao
+        # QueryParams pré-codificado uma vez; por página só o "pagina" muda
+        query = httpx.QueryParams(base_params)
+
+        async def _pagina(pagina: int) -> list[dict]:
+            resp = await self.get_async("nfe", params=query.set("pagina", pagina))
+            return resp.get("data", [])
+
+        logger.info("Listando NF-es — página 1")
+        registros = await _pagina(1)
+        todas = list(registros)
         pagina = 1
 
-        while True:
-            logger.info("Listando NF-es — página %d", pagina)
-            resp = self.listar_nfes(
-                data_inicio=data_inicio,
-                data_fim=data_fim,
-                situacao=situacao,
-                pagina=pagina,
-            )
-            registros = resp.get("data", [])
-            todas.extend(registros)
+        while len(registros) >= self._page_size:
+            janela = range(pagina + 1, pagina + 1 + MAX_CONCURRENCY)
+            logger.info("Listando NF-es — páginas %d a %d", janela[0], janela[-1])
+            resultados = await asyncio.gather(*(_pagina(p) for p in janela))
+
+            registros = resultados[-1]
+            for regs in resultados:
+                todas.extend(regs)
+                if len(regs) < self._page_size:
+                    registros = regs
+                    break
+            pagina = janela[-1]
 
             logger.info(
-                "Página %d: %d registros (total acumulado: %d)",
-                pagina,
-                len(registros),
-                len(todas),
+                "Páginas até %d: total acumulado %d registros", pagina, len(todas)
             )
 
-            if len(registros) < self._page_size:
-                break
-            pagina += 1
-
-        logger.info("Listagem completa: %d NF-es em %d páginas", len(todas), pagina)
+        logger.info("Listagem completa: %d NF-es", len(todas))
         return todas
 
     def detalhar_nfe(self, nfe_id: int) -> dict:
         return self.get(f"nfe/{nfe_id}")
 
+    async def detalhar_nfe_async(self, nfe_id: int) -> dict:
+        return await self.get_async(f"nfe/{nfe_id}")
+
+    def _bulk_threads(self, chaves: list, fn: Callable) -> list[tuple]:
+        """Fallback do fan-out em lote quando o thread já tem event loop.
+
+        Mesmo contrato dos métodos *_bulk: resultados na ordem das chaves,
+        com Exception no lugar da resposta em caso de falha individual.
+        """
+        resultados: dict = {}
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+            futuros = {executor.submit(fn, chave): chave for chave in chaves}
+            for futuro in as_completed(futuros):
+                chave = futuros[futuro]
+                try:
+                    resultados[chave] = futuro.result()
+                except Exception as exc:
+                    resultados[chave] = exc
+        return [(chave, resultados[chave]) for chave in chaves]
+
+    @staticmethod
+    def _tem_loop_rodando() -> bool:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
     # ── Contatos ─────────────────────────────────────────────────────────
 
     def buscar_contato(self, contato_id: int) -> dict:
         return self.get(f"contatos/{contato_id}")
 
+    def buscar_contatos_bulk(
+        self, contato_ids: list[int]
+    ) -> list[tuple[int, dict | Exception]]:
+        """Busca vários contatos multiplexados na conexão HTTP/2.
+
+        A API Bling v3 não tem endpoint de lote para contatos; as N buscas
+        são disparadas concorrentemente na mesma conexão. Falhas individuais
+        voltam como Exception no lugar da resposta.
+        """
+        if self._tem_loop_rodando():
+            # asyncio.run falharia; mesmo fan-out via threads
+            return self._bulk_threads(contato_ids, self.buscar_contato)
+
+        async def _run() -> list[tuple[int, dict | Exception]]:
+            sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+            async def _um(contato_id: int) -> dict:
+                async with sem:
+                    return await self.get_async(f"contatos/{contato_id}")
+
+            try:
+                resultados = await asyncio.gather(
+                    *(_um(c) for c in contato_ids), return_exceptions=True
+                )
+            finally:
+                await self.aclose()
+            return list(zip(contato_ids, resultados))
+
+        return asyncio.run(_run())
+
     # ── Produtos ─────────────────────────────────────────────────────────
 
     def buscar_produto(self, produto_id: int) -> dict:
         return self.get(f"produtos/{produto_id}")
 
+    def _buscar_produto_codigo(self, codigo: str) -> dict | None:
+        resp = self.get("produtos", params={"codigo": codigo})
+        data = resp.get("data", [])
+        return data[0] if data else None
+
     def buscar_produto_por_codigo(self, codigo: str) -> dict | None:
         try:
-            resp = self.get("produtos", params={"codigo": codigo})
-            data = resp.get("data", [])
-            return data[0] if data else None
+            return self._buscar_produto_codigo(codigo)
         except Exception:
             logger.warning("Produto código=%s não encontrado", codigo)
             return None
+
+    def buscar_produtos_bulk(
+        self, codigos: list[str]
+    ) -> list[tuple[str, dict | None | Exception]]:
+        """Busca vários produtos por código, multiplexados na conexão HTTP/2.
+
+        Cada resultado é o primeiro produto retornado pela busca por código,
+        None quando não encontrado, ou Exception em caso de falha.
+        """
+        if self._tem_loop_rodando():
+            # asyncio.run falharia; mesmo fan-out via threads
+            return self._bulk_threads(codigos, self._buscar_produto_codigo)
+
+        async def _run() -> list[tuple[str, dict | None | Exception]]:
+            sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+            async def _um(codigo: str) -> dict | None:
+                async with sem:
+                    resp = await self.get_async("produtos", params={"codigo": codigo})
+                data = resp.get("data", [])
+                return data[0] if data else None
+
+            try:
+                resultados = await asyncio.gather(
+                    *(_um(c) for c in codigos), return_exceptions=True
+                )
+            finally:
+                await self.aclose()
+            return list(zip(codigos, resultados))
+
+        return asyncio.run(_run())
+
+
+# ── Client compartilhado ─────────────────────────────────────────────────
+
+
+_client_compartilhado: BlingClient | None = None
+_client_compartilhado_lock = threading.Lock()
+
+
+def get_bling_client(access_token: str) -> BlingClient:
+    """Retorna o BlingClient compartilhado do processo.
+
+    O pool de conexões é amortizado entre execuções do pipeline. Quando o
+    access_token rota, o client antigo é fechado antes de ser substituído
+    — um lru_cache descartaria a entrada sem liberar o pool.
+    """
+    global _client_compartilhado
+    with _client_compartilhado_lock:
+        if (
+            _client_compartilhado is None
+            or _client_compartilhado._access_token != access_token
+        ):
+            if _client_compartilhado is not None:
+                _client_compartilhado.close()
+            _client_compartilhado = BlingClient(access_token)
+        return _client_compartilhado
@@ -1,6 +1,8 @@
 import base64
 import logging
+import threading
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 import httpx
 from sqlalchemy.orm import Session
@@ -11,9 +13,42 @@ from src.db.repository import get_oauth_token, save_oauth_token
 logger = logging.getLogger(__name__)
 
 TIMEOUT = 30
+REFRESH_MARGIN = timedelta(minutes=10)
 
+# Cache em memória do token vigente: evita um SELECT por chamada de API.
+# Só volta ao banco quando o token está a menos de REFRESH_MARGIN de expirar.
+_token_cache: tuple[str, datetime] | None = None
+_token_cache_lock = threading.Lock()
 
+
+def _cache_token(access_token: str, expires_at: datetime) -> None:
+    global _token_cache
+    with _token_cache_lock:
+        _token_cache = (access_token, expires_at)
+
+
+@lru_cache
+def _get_oauth_headers() -> dict:
+    """Headers fixos das chamadas OAuth, montados uma única vez."""
+    return {
+        "Authorization": _get_basic_auth_header(),
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
+
+@lru_cache
+def _get_oauth_client() -> httpx.Client:
+    """Client compartilhado para o endpoint OAuth — evita handshake por chamada."""
+    return httpx.Client(
+        http2=True,
+        timeout=TIMEOUT,
+        limits=httpx.Limits(max_keepalive_connections=2),
+    )
+
+
+@lru_cache
 def _get_basic_auth_header() -> str:
+    # Credenciais são imutáveis durante a vida do processo
     settings = get_settings()
     credentials = f"{settings.BLING_CLIENT_ID}:{settings.BLING_CLIENT_SECRET}"
     encoded = base64.b64encode(credentials.encode()).decode()
@@ -25,26 +60,27 @@ def exchange_authorization_code(db: Session, code: str) -> dict:
     settings = get_settings()
     logger.info("Trocando authorization code por tokens...")
 
-    response = httpx.post(
+    response = _get_oauth_client().post(
         settings.BLING_OAUTH_URL,
-        headers={
-            "Authorization": _get_basic_auth_header(),
-            "Content-Type": "application/x-www-form-urlencoded",
-        },
+        headers=_get_oauth_headers(),
         data={
             "grant_type": "authorization_code",
             "code": code,
         },
-        timeout=TIMEOUT,
     )
     response.raise_for_status()
     data = response.json()
 
+    expires_in = data.get("expires_in", 21600)
     save_oauth_token(
         db=db,
         access_token=data["access_token"],
         refresh_token=data["refresh_token"],
-        expires_in=data.get("expires_in", 21600),
+        expires_in=expires_in,
+    )
+    _cache_token(
+        data["access_token"],
+        datetime.now(timezone.utc) + timedelta(seconds=expires_in),
     )
     logger.info("Tokens salvos com sucesso (authorization code)")
     return data
@@ -60,20 +96,26 @@ def refresh_access_token(db: Session) -> str:
             "Nenhum token encontrado no banco. Execute first_auth.py primeiro."
         )
 
+    # Token ainda longe de expirar: renovar seria puro desperdício. A mesma
+    # REFRESH_MARGIN do get_valid_access_token — um guard mais apertado aqui
+    # faria aquele caminho dizer "renovando" sem renovar de fato
+    expires_at = token.expires_at.replace(tzinfo=timezone.utc)
+    remaining = expires_at - datetime.now(timezone.utc)
+    if remaining > REFRESH_MARGIN:
+        logger.debug("Refresh ignorado: token ainda válido por %s", remaining)
+        _cache_token(token.access_token, expires_at)
+        return token.access_token
+
     logger.info("Renovando access_token via refresh_token...")
 
     try:
-        response = httpx.post(
+        response = _get_oauth_client().post(
             settings.BLING_OAUTH_URL,
-            headers={
-                "Authorization": _get_basic_auth_header(),
-                "Content-Type": "application/x-www-form-urlencoded",
-            },
+            headers=_get_oauth_headers(),
             data={
                 "grant_type": "refresh_token",
                 "refresh_token": token.refresh_token,
             },
-            timeout=TIMEOUT,
         )
         response.raise_for_status()
     except httpx.HTTPStatusError as e:
@@ -89,11 +131,16 @@ def refresh_access_token(db: Session) -> str:
     data = response.json()
 
     # CRÍTICO: salvar imediatamente — o refresh_token antigo já foi invalidado
+    expires_in = data.get("expires_in", 21600)
     save_oauth_token(
         db=db,
         access_token=data["access_token"],
         refresh_token=data["refresh_token"],
-        expires_in=data.get("expires_in", 21600),
+        expires_in=expires_in,
+    )
+    _cache_token(
+        data["access_token"],
+        datetime.now(timezone.utc) + timedelta(seconds=expires_in),
     )
     logger.info("Tokens renovados e salvos com sucesso")
     return data["access_token"]
@@ -101,6 +148,16 @@ def refresh_access_token(db: Session) -> str:
 
 def get_valid_access_token(db: Session) -> str:
     """Retorna um access_token válido, renovando se necessário."""
+    now = datetime.now(timezone.utc)
+
+    # Caminho rápido: token em memória ainda longe de expirar
+    with _token_cache_lock:
+        if _token_cache is not None:
+            access_token, expires_at = _token_cache
+            if expires_at - now > REFRESH_MARGIN:
+                logger.debug("Token válido em cache (expira em %s)", expires_at - now)
+                return access_token
+
     token = get_oauth_token(db)
 
     if not token:
@@ -108,15 +165,15 @@ def get_valid_access_token(db: Session) -> str:
             "Nenhum token encontrado no banco. Execute first_auth.py primeiro."
         )
 
-    now = datetime.now(timezone.utc)
     expires_at = token.expires_at.replace(tzinfo=timezone.utc)
     remaining = expires_at - now
 
-    if remaining < timedelta(minutes=10):
+    if remaining < REFRESH_MARGIN:
         logger.info(
             "Token expira em %s — renovando...", remaining
         )
         return refresh_access_token(db)
 
     logger.debug("Token válido (expira em %s)", remaining)
+    _cache_token(token.access_token, expires_at)
     return token.access_token
@@ -1,17 +1,32 @@
 from collections.abc import Generator
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import DeclarativeBase, Session, sessionmaker
 
 from src.config import get_settings
 
 settings = get_settings()
 
+
+def _database_url() -> str:
+    # Força o driver psycopg3 mesmo com a URL genérica "postgresql://"
+    url = settings.DATABASE_URL
+    if url.startswith("postgresql://"):
+        url = url.replace("postgresql://", "postgresql+psycopg://", 1)
+    return url
+
+
 engine = create_engine(
-    settings.DATABASE_URL,
+    _database_url(),
     pool_size=5,
     max_overflow=10,
     pool_pre_ping=True,
+    insertmanyvalues_page_size=1000,
+    # Cache de SQL compilado maior que o padrão (500): os upserts em lote
+    # variam por tamanho de página e não devem despejar as queries quentes
+    query_cache_size=1200,
+    # Auto-prepare no servidor a partir da 3ª execução de cada statement
+    connect_args={"prepare_threshold": 3},
 )
 
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
@@ -21,6 +36,24 @@ class Base(DeclarativeBase):
     pass
 
 
+_schema_initialized = False
+
+
+def init_schema() -> None:
+    """Garante que as tabelas existem, sem re-checar o catálogo a cada start.
+
+    create_all emite um SELECT em pg_catalog por tabela; aqui uma única
+    consulta has_table decide se a criação é necessária, e a sentinela em
+    memória evita qualquer round-trip nas chamadas seguintes do processo.
+    """
+    global _schema_initialized
+    if _schema_initialized:
+        return
+    if not inspect(engine).has_table("etl_controle"):
+        Base.metadata.create_all(bind=engine)
+    _schema_initialized = True
+
+
 def get_db() -> Generator[Session]:
     db = SessionLocal()
     try:
@@ -11,6 +11,7 @@ from sqlalchemy import (
     Text,
     UniqueConstraint,
     ForeignKey,
+    text,
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -25,6 +26,9 @@ def _utcnow() -> datetime:
 
 class OAuthToken(Base):
     __tablename__ = "oauth_tokens"
+    # UNLOGGED: a linha única é reescrita a cada refresh e é recriável via
+    # first_auth.py — não vale o custo de WAL a cada rotação de token
+    __table_args__ = {"prefixes": ["UNLOGGED"]}
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, default=1)
     access_token: Mapped[str] = mapped_column(Text, nullable=False)
@@ -40,6 +44,15 @@ class OAuthToken(Base):
 
 class NfeCabecalho(Base):
     __tablename__ = "nfe_cabecalho"
+    __table_args__ = (
+        # Cobre "NF-es no período com situação X" com index-only scan
+        Index(
+            "ix_nfe_data_situacao",
+            "data_emissao",
+            "situacao",
+            postgresql_include=["id", "total_nota", "contato_id"],
+        ),
+    )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
     numero: Mapped[str | None] = mapped_column(String(50), index=True)
@@ -142,6 +155,14 @@ class EtlControle(Base):
     __table_args__ = (
         Index("ix_etl_controle_status", "status"),
         Index("ix_etl_controle_data_ref", "data_referencia"),
+        # No máximo uma execução running por vez — fecha a corrida entre a
+        # checagem do /run e o INSERT quando dois POSTs chegam juntos
+        Index(
+            "uq_etl_controle_running",
+            "status",
+            unique=True,
+            postgresql_where=text("status = 'running'"),
+        ),
     )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -1,7 +1,7 @@
 import logging
 from datetime import date, datetime, timedelta, timezone
 
-from sqlalchemy import select, delete
+from sqlalchemy import delete, insert, select, update
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
@@ -33,24 +33,29 @@ def save_oauth_token(
     db: Session, access_token: str, refresh_token: str, expires_in: int
 ) -> None:
     expires_at = _utcnow() + timedelta(seconds=expires_in)
-    stmt = pg_insert(OAuthToken).values(
-        id=1,
-        access_token=access_token,
-        refresh_token=refresh_token,
-        token_type="Bearer",
-        expires_at=expires_at,
-        updated_at=_utcnow(),
-    )
-    stmt = stmt.on_conflict_do_update(
-        index_elements=["id"],
-        set_={
-            "access_token": stmt.excluded.access_token,
-            "refresh_token": stmt.excluded.refresh_token,
-            "expires_at": stmt.excluded.expires_at,
-            "updated_at": stmt.excluded.updated_at,
-        },
+
+    # Caminho rápido: depois do first_auth a linha id=1 sempre existe
+    result = db.execute(
+        update(OAuthToken)
+        .where(OAuthToken.id == 1)
+        .values(
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires_at=expires_at,
+            updated_at=_utcnow(),
+        )
     )
-    db.execute(stmt)
+    if result.rowcount == 0:
+        db.execute(
+            pg_insert(OAuthToken).values(
+                id=1,
+                access_token=access_token,
+                refresh_token=refresh_token,
+                token_type="Bearer",
+                expires_at=expires_at,
+                updated_at=_utcnow(),
+            )
+        )
     db.commit()
     logger.info("Token OAuth salvo/atualizado (expira em %d segundos)", expires_in)
 
@@ -58,22 +63,68 @@ def save_oauth_token(
 # ── NF-e ─────────────────────────────────────────────────────────────────────
 
 
-def upsert_nfe_cabecalho(db: Session, data: dict) -> int:
-    stmt = pg_insert(NfeCabecalho).values(**data)
-    stmt = stmt.on_conflict_do_update(
+def _montar_upsert(model, colunas: tuple[str, ...]):
+    """Upsert em lote via executemany: um INSERT ... ON CONFLICT para N linhas.
+
+    Construído uma vez por tabela na importação do módulo — as linhas do
+    pipeline têm sempre o mesmo conjunto de chaves, então o statement pode
+    ser constante e o cache de compilação do SQLAlchemy acerta sempre.
+    """
+    stmt = pg_insert(model)
+    return stmt.on_conflict_do_update(
         index_elements=["id"],
-        set_={k: stmt.excluded[k] for k in data if k != "id"},
+        set_={c: stmt.excluded[c] for c in colunas},
     )
-    result = db.execute(stmt)
-    db.flush()
-    nfe_id = data["id"]
-    logger.debug("Upsert NF-e cabeçalho id=%d", nfe_id)
-    return nfe_id
 
 
-def upsert_nfe_itens(db: Session, nfe_id: int, itens: list[dict]) -> None:
-    db.execute(delete(NfeItem).where(NfeItem.nfe_id == nfe_id))
-    if itens:
+_UPSERT_NFE_CABECALHO = _montar_upsert(
+    NfeCabecalho,
+    (
+        "numero",
+        "data_emissao",
+        "situacao",
+        "contato_id",
+        "contato_nome",
+        "contato_documento",
+        "contato_municipio",
+        "contato_uf",
+        "total_produtos",
+        "total_nota",
+        "total_descontos",
+    ),
+)
+_UPSERT_CONTATO = _montar_upsert(
+    Contato,
+    ("nome", "documento", "email", "tipo_pessoa", "municipio", "uf"),
+)
+_UPSERT_PRODUTO = _montar_upsert(
+    Produto,
+    (
+        "codigo",
+        "nome",
+        "preco_venda",
+        "preco_custo",
+        "categoria_id",
+        "categoria_descricao",
+    ),
+)
+# Pós-DELETE e pós-agrupamento não sobra conflito legítimo em itens; o DO
+# NOTHING é só uma salvaguarda contra corrida com outra execução.
+_INSERT_NFE_ITEM = pg_insert(NfeItem).on_conflict_do_nothing(constraint="uq_nfe_item")
+_INSERT_NFE_PAGAMENTO = pg_insert(NfePagamento)
+
+
+def upsert_nfe_cabecalhos(db: Session, rows: list[dict]) -> None:
+    if not rows:
+        return
+    db.execute(_UPSERT_NFE_CABECALHO, rows)
+    logger.debug("Upsert em lote: %d cabeçalhos NF-e", len(rows))
+
+
+def _montar_linhas_itens(por_nfe: dict[int, list[dict]]) -> list[dict]:
+    """Achata itens por NF-e em linhas, agrupando codigo_produto duplicado."""
+    rows: list[dict] = []
+    for nfe_id, itens in por_nfe.items():
         # Agrupar itens duplicados (mesmo codigo_produto na mesma NF-e)
         agrupados: dict[str | None, dict] = {}
         for item in itens:
@@ -85,69 +136,176 @@ def upsert_nfe_itens(db: Session, nfe_id: int, itens: list[dict]) -> None:
                 agrupados[chave]["valor_desconto"] += item.get("valor_desconto", 0)
             else:
                 agrupados[chave] = dict(item)
-        db.execute(pg_insert(NfeItem).values(list(agrupados.values())))
-    logger.debug("NF-e %d: %d itens substituídos", nfe_id, len(itens))
+        rows.extend(agrupados.values())
+    return rows
+
 
+def upsert_nfe_itens(db: Session, itens_por_nfe: list[tuple[int, list[dict]]]) -> None:
+    """Substitui os itens de um lote de NF-es: um DELETE + um INSERT multi-row."""
+    # A mesma NF-e pode aparecer duas vezes no lote (listagem repetida);
+    # a última ocorrência vence — o DELETE roda uma vez só por nfe_id.
+    por_nfe: dict[int, list[dict]] = dict(itens_por_nfe)
+    if not por_nfe:
+        return
+    db.execute(delete(NfeItem).where(NfeItem.nfe_id.in_(list(por_nfe))))
+
+    rows = _montar_linhas_itens(por_nfe)
+    if rows:
+        db.execute(_INSERT_NFE_ITEM, rows)
+    logger.debug("%d NF-es: %d itens substituídos em lote", len(por_nfe), len(rows))
+
+
+_NFE_ITEM_COPY_COLUMNS = (
+    "nfe_id",
+    "codigo_produto",
+    "descricao_produto",
+    "quantidade",
+    "valor_unitario",
+    "valor_total",
+    "valor_desconto",
+    "unidade_medida",
+)
+
+_NFE_PAGAMENTO_COPY_COLUMNS = (
+    "nfe_id",
+    "tipo_pagamento",
+    "valor",
+)
+
+
+def _copy_rows(db: Session, tabela: str, colunas: tuple[str, ...], rows: list[dict]) -> None:
+    """COPY FROM STDIN via psycopg3 — bypassa parser SQL e ON CONFLICT."""
+    cols = ", ".join(colunas)
+    raw = db.connection().connection.driver_connection
+    with raw.cursor() as cur:
+        with cur.copy(f"COPY {tabela} ({cols}) FROM STDIN") as cp:
+            for row in rows:
+                cp.write_row(tuple(row.get(c) for c in colunas))
+    logger.debug("COPY %s: %d linhas", tabela, len(rows))
+
+
+def bulk_copy_nfe_itens(db: Session, itens_por_nfe: list[tuple[int, list[dict]]]) -> None:
+    """Insere itens via COPY — só para carga inicial (tabela vazia, sem DELETE).
 
-def upsert_nfe_pagamentos(db: Session, nfe_id: int, pagamentos: list[dict]) -> None:
-    db.execute(delete(NfePagamento).where(NfePagamento.nfe_id == nfe_id))
-    if pagamentos:
+    Agrupa duplicados como o upsert para não violar uq_nfe_item; para o
+    delta diário permanece o upsert em lote de upsert_nfe_itens.
+    """
+    rows = _montar_linhas_itens(dict(itens_por_nfe))
+    if rows:
+        _copy_rows(db, "nfe_itens", _NFE_ITEM_COPY_COLUMNS, rows)
+
+
+def bulk_copy_nfe_pagamentos(
+    db: Session, pagamentos_por_nfe: list[tuple[int, list[dict]]]
+) -> None:
+    """Insere pagamentos via COPY — só para carga inicial (tabela vazia)."""
+    # Mesma dedupe do upsert: nfe_id repetido no lote, a última ocorrência
+    # vence — sem isso o COPY duplicaria as linhas silenciosamente
+    por_nfe: dict[int, list[dict]] = dict(pagamentos_por_nfe)
+    rows: list[dict] = []
+    for nfe_id, pagamentos in por_nfe.items():
         for pag in pagamentos:
             pag["nfe_id"] = nfe_id
-        db.execute(pg_insert(NfePagamento).values(pagamentos))
-    logger.debug("NF-e %d: %d pagamentos substituídos", nfe_id, len(pagamentos))
+        rows.extend(pagamentos)
+    if rows:
+        _copy_rows(db, "nfe_pagamentos", _NFE_PAGAMENTO_COPY_COLUMNS, rows)
+
+
+def upsert_nfe_pagamentos(
+    db: Session, pagamentos_por_nfe: list[tuple[int, list[dict]]]
+) -> None:
+    """Substitui os pagamentos de um lote de NF-es: um DELETE + um INSERT multi-row."""
+    por_nfe: dict[int, list[dict]] = dict(pagamentos_por_nfe)
+    if not por_nfe:
+        return
+    db.execute(delete(NfePagamento).where(NfePagamento.nfe_id.in_(list(por_nfe))))
+
+    rows: list[dict] = []
+    for nfe_id, pagamentos in por_nfe.items():
+        for pag in pagamentos:
+            pag["nfe_id"] = nfe_id
+        rows.extend(pagamentos)
+
+    if rows:
+        db.execute(_INSERT_NFE_PAGAMENTO, rows)
+    logger.debug(
+        "%d NF-es: %d pagamentos substituídos em lote", len(por_nfe), len(rows)
+    )
+
+
+def has_nfe_cabecalhos(db: Session) -> bool:
+    """True se nfe_cabecalho já tem alguma linha (decide carga COPY vs upsert)."""
+    return db.execute(select(NfeCabecalho.id).limit(1)).first() is not None
+
+
+def get_existing_nfe_ids(db: Session, candidate_ids: set[int]) -> set[int]:
+    """IDs do lote que já existem em nfe_cabecalho — range scan no PK."""
+    if not candidate_ids:
+        return set()
+    rows = db.scalars(
+        select(NfeCabecalho.id).where(NfeCabecalho.id.in_(sorted(candidate_ids)))
+    ).all()
+    return set(rows)
 
 
 # ── Contatos ─────────────────────────────────────────────────────────────────
 
 
-def get_existing_contato_ids(db: Session) -> set[int]:
-    rows = db.scalars(select(Contato.id)).all()
+def get_existing_contato_ids(db: Session, candidate_ids: set[int]) -> set[int]:
+    """IDs do lote que já existem em contatos — range scan no PK, não full scan."""
+    if not candidate_ids:
+        return set()
+    rows = db.scalars(
+        select(Contato.id).where(Contato.id.in_(sorted(candidate_ids)))
+    ).all()
     return set(rows)
 
 
-def upsert_contato(db: Session, data: dict) -> None:
-    stmt = pg_insert(Contato).values(**data)
-    stmt = stmt.on_conflict_do_update(
-        index_elements=["id"],
-        set_={k: stmt.excluded[k] for k in data if k != "id"},
-    )
-    db.execute(stmt)
-    logger.debug("Upsert contato id=%d", data["id"])
+def upsert_contatos(db: Session, rows: list[dict]) -> None:
+    if not rows:
+        return
+    db.execute(_UPSERT_CONTATO, rows)
+    logger.debug("Upsert em lote: %d contatos", len(rows))
 
 
 # ── Produtos ─────────────────────────────────────────────────────────────────
 
 
-def get_existing_produto_codigos(db: Session) -> set[str]:
-    rows = db.scalars(select(Produto.codigo)).all()
-    return {c for c in rows if c is not None}
+def get_existing_produto_codigos(db: Session, candidate_codigos: set[str]) -> set[str]:
+    """Códigos do lote que já existem em produtos — range scan no índice único."""
+    if not candidate_codigos:
+        return set()
+    rows = db.scalars(
+        select(Produto.codigo).where(Produto.codigo.in_(sorted(candidate_codigos)))
+    ).all()
+    return set(rows)
 
 
-def upsert_produto(db: Session, data: dict) -> None:
-    stmt = pg_insert(Produto).values(**data)
-    stmt = stmt.on_conflict_do_update(
-        index_elements=["id"],
-        set_={k: stmt.excluded[k] for k in data if k != "id"},
-    )
-    db.execute(stmt)
-    logger.debug("Upsert produto id=%d", data["id"])
+def upsert_produtos(db: Session, rows: list[dict]) -> None:
+    if not rows:
+        return
+    db.execute(_UPSERT_PRODUTO, rows)
+    logger.debug("Upsert em lote: %d produtos", len(rows))
 
 
 # ── ETL Controle ─────────────────────────────────────────────────────────────
 
 
 def create_etl_run(db: Session, data_referencia: date) -> int:
-    run = EtlControle(
-        inicio=_utcnow(),
-        status="running",
-        data_referencia=data_referencia,
-    )
-    db.add(run)
+    # Core insert com RETURNING: sem objeto no identity map nem o SELECT
+    # extra do db.refresh — a linha só interessa pelo id
+    run_id = db.execute(
+        insert(EtlControle)
+        .values(
+            inicio=_utcnow(),
+            status="running",
+            data_referencia=data_referencia,
+        )
+        .returning(EtlControle.id)
+    ).scalar_one()
     db.commit()
-    db.refresh(run)
-    logger.info("ETL run #%d criada (ref: %s)", run.id, data_referencia)
-    return run.id
+    logger.info("ETL run #%d criada (ref: %s)", run_id, data_referencia)
+    return run_id
 
 
 def finish_etl_run(
@@ -159,23 +317,85 @@ def finish_etl_run(
     produtos: int = 0,
     erro: str | None = None,
 ) -> None:
-    run = db.get(EtlControle, run_id)
-    if not run:
+    result = db.execute(
+        update(EtlControle)
+        .where(EtlControle.id == run_id)
+        .values(
+            fim=_utcnow(),
+            status=status,
+            nfes_processadas=nfes,
+            contatos_novos=contatos,
+            produtos_novos=produtos,
+            erro_mensagem=erro,
+        )
+    )
+    if result.rowcount == 0:
         logger.error("ETL run #%d não encontrada", run_id)
         return
-    run.fim = _utcnow()
-    run.status = status
-    run.nfes_processadas = nfes
-    run.contatos_novos = contatos
-    run.produtos_novos = produtos
-    run.erro_mensagem = erro
     db.commit()
     logger.info("ETL run #%d finalizada: status=%s, nfes=%d", run_id, status, nfes)
 
 
+# Execução running mais velha que isso é considerada órfã: o processo
+# morreu (SIGKILL, OOM, instância recolhida) antes do finish_etl_run
+STALE_RUN_MAX_AGE = timedelta(hours=6)
+
+
+def has_running_etl(db: Session) -> bool:
+    """True se alguma execução ainda está com status=running (guarda do /run).
+
+    Linhas running mais velhas que STALE_RUN_MAX_AGE são ignoradas — sem o
+    corte, uma execução órfã bloquearia /run para sempre.
+    """
+    limite = _utcnow() - STALE_RUN_MAX_AGE
+    return (
+        db.execute(
+            select(EtlControle.id)
+            .where(EtlControle.status == "running", EtlControle.inicio >= limite)
+            .limit(1)
+        ).first()
+        is not None
+    )
+
+
+def fail_stale_etl_runs(db: Session) -> int:
+    """Marca como error execuções running órfãs; retorna quantas limpou.
+
+    Chamado no startup e antes de agendar um run novo: além de corrigir o
+    histórico, libera o índice único parcial de status=running para a
+    próxima execução.
+    """
+    result = db.execute(
+        update(EtlControle)
+        .where(
+            EtlControle.status == "running",
+            EtlControle.inicio < _utcnow() - STALE_RUN_MAX_AGE,
+        )
+        .values(
+            fim=_utcnow(),
+            status="error",
+            erro_mensagem="Execução órfã: processo encerrado sem finalizar",
+        )
+    )
+    if result.rowcount:
+        db.commit()
+        logger.warning("%d execução(ões) órfã(s) marcada(s) como error", result.rowcount)
+    return result.rowcount
+
+
 def get_last_successful_run(db: Session) -> EtlControle | None:
     return db.scalars(
         select(EtlControle)
         .where(EtlControle.status == "success")
         .order_by(EtlControle.data_referencia.desc())
     ).first()
+
+
+def get_last_successful_run_date(db: Session) -> date | None:
+    """Só a data_referencia da última execução com sucesso, sem materializar ORM."""
+    return db.execute(
+        select(EtlControle.data_referencia)
+        .where(EtlControle.status == "success")
+        .order_by(EtlControle.data_referencia.desc())
+        .limit(1)
+    ).scalar_one_or_none()
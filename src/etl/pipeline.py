@@ -1,33 +1,51 @@
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, datetime, timedelta, timezone
 
 from sqlalchemy.orm import Session
 
-from src.api.bling_client import BlingClient
+from src.api.bling_client import MAX_CONCURRENCY, BlingClient, get_bling_client
 from src.auth.oauth import get_valid_access_token
 from src.config import get_settings
 from src.db.repository import (
+    bulk_copy_nfe_itens,
+    bulk_copy_nfe_pagamentos,
     create_etl_run,
     finish_etl_run,
+    has_nfe_cabecalhos,
+    get_last_successful_run_date,
     get_existing_contato_ids,
+    get_existing_nfe_ids,
     get_existing_produto_codigos,
-    get_last_successful_run,
-    upsert_contato,
-    upsert_nfe_cabecalho,
+    upsert_contatos,
+    upsert_nfe_cabecalhos,
     upsert_nfe_itens,
     upsert_nfe_pagamentos,
-    upsert_produto,
+    upsert_produtos,
 )
 
 logger = logging.getLogger(__name__)
 
-CHECKPOINT_INTERVAL = 50
+# Flush dirigido por volume ou tempo, não por contagem de NF-e: commits a
+# cada N linhas forçam um fsync por lote pequeno e limitam o throughput
+FLUSH_MAX_ROWS = 1000
+FLUSH_MAX_SECONDS = 5.0
 
 
 # ── Funções auxiliares ───────────────────────────────────────────────────────
 
 
 def _to_float(val) -> float:
+    # Caminhos rápidos sem try/except: a API devolve muito None, e levantar
+    # exceção custa ordens de grandeza mais que estes testes de tipo
+    if val is None:
+        return 0.0
+    if type(val) is float:
+        return val
+    if type(val) is int:
+        return float(val)
     try:
         return float(val)
     except (TypeError, ValueError):
@@ -35,22 +53,17 @@ def _to_float(val) -> float:
 
 
 def _to_int(val) -> int | None:
+    if val is None:
+        return None
+    if type(val) is int:
+        return val
     try:
         return int(val)
     except (TypeError, ValueError):
         return None
 
 
-def _safe_get(data, *keys, default=None):
-    """Navegação segura em dicts aninhados."""
-    current = data
-    for key in keys:
-        if not isinstance(current, dict):
-            return default
-        current = current.get(key)
-        if current is None:
-            return default
-    return current
+_ONE_DAY = timedelta(days=1)
 
 
 def _gerar_periodos_mensais(data_inicio: str, data_fim: str) -> list[tuple[str, str]]:
@@ -61,15 +74,13 @@ def _gerar_periodos_mensais(data_inicio: str, data_fim: str) -> list[tuple[str,
 
     cursor = inicio
     while cursor <= fim:
-        # Último dia do mês corrente
-        if cursor.month == 12:
-            fim_mes = date(cursor.year + 1, 1, 1) - timedelta(days=1)
-        else:
-            fim_mes = date(cursor.year, cursor.month + 1, 1) - timedelta(days=1)
+        # Último dia do mês corrente: 1º do mês seguinte menos um dia
+        ano, mes = cursor.year, cursor.month
+        fim_mes = date(ano + (mes == 12), mes % 12 + 1, 1) - _ONE_DAY
 
         periodo_fim = min(fim_mes, fim)
         periodos.append((cursor.isoformat(), periodo_fim.isoformat()))
-        cursor = periodo_fim + timedelta(days=1)
+        cursor = periodo_fim + _ONE_DAY
 
     return periodos
 
@@ -81,20 +92,111 @@ class Pipeline:
     def __init__(self, db: Session) -> None:
         self.db = db
         self.stats = {"nfes": 0, "contatos": 0, "produtos": 0}
+        # Buffers de linhas, descarregados em lote a cada checkpoint
+        self._cabecalhos_pendentes: list[dict] = []
+        self._itens_pendentes: list[tuple[int, list[dict]]] = []
+        self._pagamentos_pendentes: list[tuple[int, list[dict]]] = []
+        self._linhas_pendentes = 0
+        self._ultimo_flush = time.monotonic()
+        # Chaves acumuladas durante a etapa NF-e; as etapas de contatos e
+        # produtos consomem só estes sets, sem reter os JSONs detalhados
+        self._seen_contato_ids: set[int] = set()
+        self._seen_produto_codigos: set[str] = set()
+        # Carga inicial (tabelas vazias): itens/pagamentos via COPY
+        self._bulk_load = False
+
+    def _flush_pendentes(self) -> None:
+        try:
+            # Cabeçalhos primeiro: itens/pagamentos têm FK para nfe_cabecalho.
+            # O upsert de cabeçalhos fica mesmo na carga inicial — mantém a
+            # idempotência se um run_full for repetido após falha parcial.
+            if self._cabecalhos_pendentes:
+                upsert_nfe_cabecalhos(self.db, self._cabecalhos_pendentes)
+            if self._itens_pendentes:
+                if self._bulk_load:
+                    bulk_copy_nfe_itens(self.db, self._itens_pendentes)
+                else:
+                    upsert_nfe_itens(self.db, self._itens_pendentes)
+            if self._pagamentos_pendentes:
+                if self._bulk_load:
+                    bulk_copy_nfe_pagamentos(self.db, self._pagamentos_pendentes)
+                else:
+                    upsert_nfe_pagamentos(self.db, self._pagamentos_pendentes)
+        except Exception:
+            # Sem rollback a sessão ficaria abortada e todo checkpoint
+            # seguinte falharia com InFailedSqlTransaction, atribuído no log
+            # a NF-es inocentes. Desfaz o lote e reaplica NF-e a NF-e para
+            # isolar (e descartar) só a linha problemática.
+            self.db.rollback()
+            logger.warning(
+                "Flush em lote falhou — reaplicando NF-e a NF-e", exc_info=True
+            )
+            self._flush_nfe_a_nfe()
+        # Buffers só são limpos depois do flush inteiro dar certo; uma falha
+        # no meio não pode descartar linhas ainda não gravadas
+        self._cabecalhos_pendentes = []
+        self._itens_pendentes = []
+        self._pagamentos_pendentes = []
+        self._linhas_pendentes = 0
+        self._ultimo_flush = time.monotonic()
+
+    def _flush_nfe_a_nfe(self) -> None:
+        """Contingência do flush: reaplica o lote com um SAVEPOINT por NF-e.
+
+        A NF-e cuja escrita falha é descartada (como no salvamento
+        individual original) e as demais seguem. Usa sempre o caminho de
+        upsert — COPY não isola falhas por linha — o que vale também na
+        carga inicial.
+        """
+        itens_por_nfe = dict(self._itens_pendentes)
+        pagamentos_por_nfe = dict(self._pagamentos_pendentes)
+        descartadas = 0
+        for cabecalho in self._cabecalhos_pendentes:
+            nfe_id = cabecalho["id"]
+            try:
+                with self.db.begin_nested():
+                    upsert_nfe_cabecalhos(self.db, [cabecalho])
+                    itens = itens_por_nfe.get(nfe_id)
+                    if itens is not None:
+                        upsert_nfe_itens(self.db, [(nfe_id, itens)])
+                    pagamentos = pagamentos_por_nfe.get(nfe_id)
+                    if pagamentos is not None:
+                        upsert_nfe_pagamentos(self.db, [(nfe_id, pagamentos)])
+            except Exception:
+                descartadas += 1
+                logger.error(
+                    "NF-e id=%s descartada no flush", nfe_id, exc_info=True
+                )
+        if descartadas:
+            self.stats["nfes"] -= descartadas
+            logger.warning(
+                "Flush individual concluído: %d NF-e descartada(s)", descartadas
+            )
+
+    def _checkpoint_se_necessario(self) -> None:
+        """Flush + commit quando o buffer encheu ou passou tempo demais."""
+        if (
+            self._linhas_pendentes >= FLUSH_MAX_ROWS
+            or time.monotonic() - self._ultimo_flush > FLUSH_MAX_SECONDS
+        ):
+            self._flush_pendentes()
+            self.db.commit()
+            logger.info("Checkpoint: %d NF-es salvas", self.stats["nfes"])
 
     def run(
         self,
         data_inicio: str | None = None,
         data_fim: str | None = None,
+        run_id: int | None = None,
     ) -> dict:
         settings = get_settings()
         now = datetime.now(timezone.utc)
 
         # 1. Determinar período
         if not data_inicio:
-            last_run = get_last_successful_run(self.db)
-            if last_run and last_run.data_referencia:
-                data_inicio = last_run.data_referencia.strftime("%Y-%m-%d")
+            last_run_date = get_last_successful_run_date(self.db)
+            if last_run_date:
+                data_inicio = last_run_date.strftime("%Y-%m-%d")
                 logger.info("Usando data da última execução: %s", data_inicio)
             else:
                 dt = now - timedelta(days=settings.EXTRACTION_DAYS_BACK)
@@ -106,24 +208,26 @@ class Pipeline:
 
         logger.info("Período de extração: %s a %s", data_inicio, data_fim)
 
-        # 2. Criar registro ETL
-        run_id = create_etl_run(self.db, now.date())
+        # 2. Criar registro ETL (a menos que o endpoint já tenha criado)
+        if run_id is None:
+            run_id = create_etl_run(self.db, now.date())
 
         try:
             # 3. Refresh do token OAuth
             logger.info("Obtendo token OAuth...")
             access_token = get_valid_access_token(self.db)
 
-            # 4. Criar client
-            with BlingClient(access_token) as client:
-                # 5. Etapa NF-e
-                nfes = self._extrair_nfes(client, data_inicio, data_fim)
+            # 4. Obter client compartilhado (pool amortizado entre execuções)
+            client = get_bling_client(access_token)
+
+            # 5. Etapa NF-e
+            self._extrair_nfes(client, data_inicio, data_fim)
 
-                # 6. Etapa Contatos
-                self._extrair_contatos(client, nfes)
+            # 6. Etapa Contatos
+            self._extrair_contatos(client)
 
-                # 7. Etapa Produtos
-                self._extrair_produtos(client, nfes)
+            # 7. Etapa Produtos
+            self._extrair_produtos(client)
 
             # 8. Commit final
             self.db.commit()
@@ -160,10 +264,12 @@ class Pipeline:
         self,
         data_inicio: str,
         data_fim: str,
+        run_id: int | None = None,
     ) -> dict:
         """Extração completa quebrando em períodos mensais."""
         now = datetime.now(timezone.utc)
-        run_id = create_etl_run(self.db, now.date())
+        if run_id is None:
+            run_id = create_etl_run(self.db, now.date())
 
         try:
             logger.info("Obtendo token OAuth...")
@@ -176,20 +282,24 @@ class Pipeline:
                 data_inicio, data_fim, len(periodos),
             )
 
-            todas_nfes = []
-            with BlingClient(access_token) as client:
-                for i, (ini, fim) in enumerate(periodos, 1):
-                    logger.info(
-                        "=== Período %d/%d: %s a %s ===",
-                        i, len(periodos), ini, fim,
-                    )
-                    nfes = self._extrair_nfes(client, ini, fim)
-                    todas_nfes.extend(nfes)
-                    self.db.commit()
+            # Base vazia: nada pode conflitar, itens/pagamentos vão via COPY
+            self._bulk_load = not has_nfe_cabecalhos(self.db)
+            if self._bulk_load:
+                logger.info("Carga inicial detectada: escrita via COPY")
+
+            client = get_bling_client(access_token)
+            for i, (ini, fim) in enumerate(periodos, 1):
+                logger.info(
+                    "=== Período %d/%d: %s a %s ===",
+                    i, len(periodos), ini, fim,
+                )
+                self._extrair_nfes(client, ini, fim)
+                self.db.commit()
 
-                # Contatos e Produtos sobre todas as NF-e coletadas
-                self._extrair_contatos(client, todas_nfes)
-                self._extrair_produtos(client, todas_nfes)
+            # Contatos e Produtos sobre as chaves acumuladas de todos os
+            # períodos — os JSONs detalhados não ficam retidos em memória
+            self._extrair_contatos(client)
+            self._extrair_produtos(client)
 
             self.db.commit()
             finish_etl_run(
@@ -216,39 +326,143 @@ class Pipeline:
 
     # ── Etapa NF-e ───────────────────────────────────────────────────────
 
+    def _filtrar_resumos_novos(self, resumos: list[dict]) -> list[dict]:
+        """Remove da listagem duplicatas e NF-e já ingeridas.
+
+        Em execuções incrementais a janela listada se sobrepõe à anterior;
+        o grosso dos resumos já está em nfe_cabecalho e não precisa de nova
+        chamada de detalhe nem de upsert. A paginação especulativa também
+        pode listar a mesma NF-e duas vezes (páginas deslizam durante a
+        listagem) — a dedupe aqui garante que cada id entra nos buffers uma
+        única vez, o que o caminho COPY da carga inicial exige (duplicata em
+        flushes distintos violaria uq_nfe_item no meio da transação).
+        """
+        candidatos = {r["id"] for r in resumos if r.get("id")}
+        existentes = get_existing_nfe_ids(self.db, candidatos)
+        vistos: set[int] = set()
+        novos: list[dict] = []
+        for resumo in resumos:
+            rid = resumo.get("id")
+            if rid in existentes or rid in vistos:
+                continue
+            if rid:
+                vistos.add(rid)
+            novos.append(resumo)
+        if len(novos) != len(resumos):
+            logger.info(
+                "NF-es puladas (já ingeridas ou repetidas): %d | %d a detalhar",
+                len(resumos) - len(novos), len(novos),
+            )
+        return novos
+
     def _extrair_nfes(
         self,
         client: BlingClient,
         data_inicio: str,
         data_fim: str,
-    ) -> list[dict]:
+    ) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass  # sem loop neste thread — caminho normal
+        else:
+            # asyncio.run falharia; cai para o fan-out com threads
+            self._extrair_nfes_threads(client, data_inicio, data_fim)
+            return
+
+        async def _run() -> None:
+            try:
+                await self._extrair_nfes_async(client, data_inicio, data_fim)
+            finally:
+                await client.aclose()
+
+        asyncio.run(_run())
+
+    def _extrair_nfes_threads(
+        self,
+        client: BlingClient,
+        data_inicio: str,
+        data_fim: str,
+    ) -> None:
+        """Fallback síncrono: mesmo fan-out, via ThreadPoolExecutor."""
+        logger.info("=== Etapa 1: Extração de NF-e (threads) ===")
+        page_size = get_settings().API_PAGE_SIZE
+        resumos: list[dict] = []
+        pagina = 1
+        while True:
+            resp = client.listar_nfes(
+                data_inicio=data_inicio, data_fim=data_fim, pagina=pagina
+            )
+            registros = resp.get("data", [])
+            resumos.extend(registros)
+            if len(registros) < page_size:
+                break
+            pagina += 1
+        logger.info("NF-es encontradas na listagem: %d", len(resumos))
+        resumos = self._filtrar_resumos_novos(resumos)
+
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+            futuros = {
+                executor.submit(client.detalhar_nfe, r.get("id")): r for r in resumos
+            }
+            # Escrita no banco fica no thread principal (Session não é thread-safe)
+            for i, futuro in enumerate(as_completed(futuros), 1):
+                resumo = futuros[futuro]
+                try:
+                    detalhe = futuro.result()
+                    self._salvar_nfe(resumo, detalhe)
+                    self.stats["nfes"] += 1
+                    self._checkpoint_se_necessario()
+                except Exception:
+                    logger.error(
+                        "Erro ao processar NF-e id=%s", resumo.get("id"), exc_info=True
+                    )
+
+                if i % 100 == 0:
+                    logger.info("Progresso NF-e: %d/%d", i, len(resumos))
+
+        self._flush_pendentes()
+        logger.info("Etapa NF-e concluída: %d processadas", self.stats["nfes"])
+
+    async def _extrair_nfes_async(
+        self,
+        client: BlingClient,
+        data_inicio: str,
+        data_fim: str,
+    ) -> None:
         logger.info("=== Etapa 1: Extração de NF-e ===")
-        resumos = client.listar_todas_nfes(data_inicio=data_inicio, data_fim=data_fim)
+        resumos = await client.listar_todas_nfes_async(
+            data_inicio=data_inicio, data_fim=data_fim
+        )
         logger.info("NF-es encontradas na listagem: %d", len(resumos))
+        resumos = self._filtrar_resumos_novos(resumos)
+
+        # Detalhes buscados concorrentemente; escrita no banco continua serial
+        sem = asyncio.Semaphore(MAX_CONCURRENCY)
 
-        nfes_detalhadas = []
-        for i, resumo in enumerate(resumos, 1):
-            nfe_id = resumo.get("id")
+        async def _detalhar(resumo: dict) -> tuple[dict, dict]:
+            async with sem:
+                return resumo, await client.detalhar_nfe_async(resumo.get("id"))
+
+        tasks = [asyncio.create_task(_detalhar(r)) for r in resumos]
+        for i, futuro in enumerate(asyncio.as_completed(tasks), 1):
+            resumo = None
             try:
-                detalhe = client.detalhar_nfe(nfe_id)
-                with self.db.begin_nested():  # SAVEPOINT por NF-e
-                    self._salvar_nfe(resumo, detalhe)
-                nfes_detalhadas.append(detalhe)
+                resumo, detalhe = await futuro
+                # _salvar_nfe só alimenta buffers; o SQL roda no flush
+                self._salvar_nfe(resumo, detalhe)
                 self.stats["nfes"] += 1
-
-                # Checkpoint a cada 50 NF-e
-                if self.stats["nfes"] % CHECKPOINT_INTERVAL == 0:
-                    self.db.commit()
-                    logger.info("Checkpoint: %d NF-es salvas", self.stats["nfes"])
+                self._checkpoint_se_necessario()
 
             except Exception:
+                nfe_id = resumo.get("id") if resumo else "?"
                 logger.error("Erro ao processar NF-e id=%s", nfe_id, exc_info=True)
 
             if i % 100 == 0:
                 logger.info("Progresso NF-e: %d/%d", i, len(resumos))
 
+        self._flush_pendentes()
         logger.info("Etapa NF-e concluída: %d processadas", self.stats["nfes"])
-        return nfes_detalhadas
 
     def _salvar_nfe(self, resumo: dict, detalhe: dict) -> None:
         nfe_id = resumo["id"]
@@ -256,18 +470,43 @@ class Pipeline:
         endereco = contato.get("endereco", {}) or {}
         dados = detalhe.get("data", {}) or {}
 
+        # Aliases locais: resolvem o nome uma vez em vez de a cada item
+        to_float = _to_float
+
         # Totais vêm direto do detalhe
-        valor_nota = _to_float(dados.get("valorNota"))
-        # Somar valorTotal dos itens para total_produtos
+        valor_nota = to_float(dados.get("valorNota"))
         itens_raw = dados.get("itens", []) or []
-        total_produtos = sum(_to_float(it.get("valorTotal")) for it in itens_raw)
+
+        # Itens vêm de data.itens[] — uma passada só monta as linhas e
+        # acumula total_produtos (antes eram duas iterações sobre itens_raw)
+        total_produtos = 0.0
+        itens = []
+        for it in itens_raw:
+            valor_total = to_float(it.get("valorTotal"))
+            total_produtos += valor_total
+            codigo = it.get("codigo")
+            if codigo:
+                self._seen_produto_codigos.add(str(codigo))
+            itens.append({
+                "codigo_produto": codigo,
+                "descricao_produto": it.get("descricao"),
+                "quantidade": to_float(it.get("quantidade")),
+                "valor_unitario": to_float(it.get("valor")),
+                "valor_total": valor_total,
+                "valor_desconto": 0,
+                "unidade_medida": it.get("unidade"),
+            })
+
+        contato_id = _to_int(contato.get("id"))
+        if contato_id:
+            self._seen_contato_ids.add(contato_id)
 
         cabecalho = {
             "id": nfe_id,
             "numero": resumo.get("numero"),
             "data_emissao": resumo.get("dataEmissao"),
             "situacao": _to_int(resumo.get("situacao")),
-            "contato_id": _to_int(contato.get("id")),
+            "contato_id": contato_id,
             "contato_nome": contato.get("nome"),
             "contato_documento": contato.get("numeroDocumento"),
             "contato_municipio": endereco.get("municipio"),
@@ -276,123 +515,96 @@ class Pipeline:
             "total_nota": valor_nota,
             "total_descontos": total_produtos - valor_nota if total_produtos > valor_nota else 0,
         }
-        upsert_nfe_cabecalho(self.db, cabecalho)
-
-        # Itens vêm de data.itens[]
-        itens = []
-        for it in itens_raw:
-            itens.append({
-                "codigo_produto": it.get("codigo"),
-                "descricao_produto": it.get("descricao"),
-                "quantidade": _to_float(it.get("quantidade")),
-                "valor_unitario": _to_float(it.get("valor")),
-                "valor_total": _to_float(it.get("valorTotal")),
-                "valor_desconto": 0,
-                "unidade_medida": it.get("unidade"),
-            })
-        upsert_nfe_itens(self.db, nfe_id, itens)
+        self._cabecalhos_pendentes.append(cabecalho)
+        self._itens_pendentes.append((nfe_id, itens))
 
         # Pagamentos vêm de data.parcelas[]
         parcelas_raw = dados.get("parcelas", []) or []
-        pagamentos = []
-        for parc in parcelas_raw:
-            pagamentos.append({
-                "tipo_pagamento": _to_int(parc.get("formaPagamento", {}).get("id")),
-                "valor": _to_float(parc.get("valor")),
-            })
-        upsert_nfe_pagamentos(self.db, nfe_id, pagamentos)
+        pagamentos = [
+            {
+                "tipo_pagamento": _to_int((parc.get("formaPagamento") or {}).get("id")),
+                "valor": to_float(parc.get("valor")),
+            }
+            for parc in parcelas_raw
+        ]
+        self._pagamentos_pendentes.append((nfe_id, pagamentos))
+        self._linhas_pendentes += 1 + len(itens) + len(pagamentos)
 
     # ── Etapa Contatos ───────────────────────────────────────────────────
 
-    def _extrair_contatos(self, client: BlingClient, nfes: list[dict]) -> None:
+    def _extrair_contatos(self, client: BlingClient) -> None:
         logger.info("=== Etapa 2: Extração de Contatos ===")
 
-        # Coletar IDs de contatos das NF-e
-        contato_ids_nfe = set()
-        for nfe in nfes:
-            cid = _to_int(_safe_get(nfe, "data", "contato", "id"))
-            if cid:
-                contato_ids_nfe.add(cid)
-
-        existentes = get_existing_contato_ids(self.db)
+        # IDs acumulados em _salvar_nfe durante a etapa NF-e
+        contato_ids_nfe = self._seen_contato_ids
+        existentes = get_existing_contato_ids(self.db, contato_ids_nfe)
         novos = contato_ids_nfe - existentes
         logger.info(
             "Contatos nas NF-e: %d | Já existentes: %d | Novos: %d",
             len(contato_ids_nfe),
-            len(existentes & contato_ids_nfe),
+            len(existentes),
             len(novos),
         )
 
-        for contato_id in novos:
-            try:
-                resp = client.buscar_contato(contato_id)
-                data = resp.get("data", {}) or {}
-                endereco_geral = _safe_get(data, "endereco", "geral") or {}
-
-                with self.db.begin_nested():  # SAVEPOINT por contato
-                    upsert_contato(self.db, {
-                        "id": contato_id,
-                        "nome": data.get("nome"),
-                        "documento": data.get("numeroDocumento"),
-                        "email": data.get("email"),
-                        "tipo_pessoa": data.get("tipo"),
-                        "municipio": endereco_geral.get("municipio"),
-                        "uf": endereco_geral.get("uf"),
-                    })
-                self.stats["contatos"] += 1
-            except Exception:
-                logger.error(
-                    "Erro ao buscar contato id=%d", contato_id, exc_info=True
-                )
+        rows: list[dict] = []
+        for contato_id, resp in client.buscar_contatos_bulk(sorted(novos)):
+            if isinstance(resp, Exception):
+                logger.error("Erro ao buscar contato id=%d: %s", contato_id, resp)
+                continue
+            data = resp.get("data", {}) or {}
+            endereco_geral = (data.get("endereco") or {}).get("geral") or {}
+
+            rows.append({
+                "id": contato_id,
+                "nome": data.get("nome"),
+                "documento": data.get("numeroDocumento"),
+                "email": data.get("email"),
+                "tipo_pessoa": data.get("tipo"),
+                "municipio": endereco_geral.get("municipio"),
+                "uf": endereco_geral.get("uf"),
+            })
 
+        upsert_contatos(self.db, rows)
+        self.stats["contatos"] += len(rows)
         logger.info("Etapa Contatos concluída: %d novos", self.stats["contatos"])
 
     # ── Etapa Produtos ───────────────────────────────────────────────────
 
-    def _extrair_produtos(self, client: BlingClient, nfes: list[dict]) -> None:
+    def _extrair_produtos(self, client: BlingClient) -> None:
         logger.info("=== Etapa 3: Extração de Produtos ===")
 
-        # Coletar códigos de produtos dos itens das NF-e
-        codigos_nfe = set()
-        for nfe in nfes:
-            itens = _safe_get(nfe, "data", "itens") or []
-            for it in itens:
-                codigo = it.get("codigo")
-                if codigo:
-                    codigos_nfe.add(str(codigo))
-
-        existentes = get_existing_produto_codigos(self.db)
+        # Códigos acumulados em _salvar_nfe durante a etapa NF-e
+        codigos_nfe = self._seen_produto_codigos
+        existentes = get_existing_produto_codigos(self.db, codigos_nfe)
         novos = codigos_nfe - existentes
         logger.info(
             "Produtos nas NF-e: %d | Já existentes: %d | Novos: %d",
             len(codigos_nfe),
-            len(existentes & codigos_nfe),
+            len(existentes),
             len(novos),
         )
 
-        for codigo in novos:
-            try:
-                produto = client.buscar_produto_por_codigo(codigo)
-                if not produto:
-                    logger.warning("Produto código=%s não encontrado na API", codigo)
-                    continue
-
-                categoria = produto.get("categoria", {}) or {}
-                fornecedor = produto.get("fornecedor", {}) or {}
-                with self.db.begin_nested():  # SAVEPOINT por produto
-                    upsert_produto(self.db, {
-                        "id": produto["id"],
-                        "codigo": codigo,
-                        "nome": produto.get("nome"),
-                        "preco_venda": _to_float(produto.get("preco")),
-                        "preco_custo": _to_float(fornecedor.get("precoCusto")),
-                        "categoria_id": _to_int(categoria.get("id")),
-                        "categoria_descricao": categoria.get("descricao"),
-                    })
-                self.stats["produtos"] += 1
-            except Exception:
-                logger.error(
-                    "Erro ao buscar produto código=%s", codigo, exc_info=True
-                )
+        rows: list[dict] = []
+        for codigo, produto in client.buscar_produtos_bulk(sorted(novos)):
+            if isinstance(produto, Exception):
+                logger.error("Erro ao buscar produto código=%s: %s", codigo, produto)
+                continue
+            if not produto:
+                logger.warning("Produto código=%s não encontrado na API", codigo)
+                continue
+
+            categoria = produto.get("categoria", {}) or {}
+            fornecedor = produto.get("fornecedor", {}) or {}
+            rows.append({
+                "id": produto["id"],
+                "codigo": codigo,
+                "nome": produto.get("nome"),
+                "preco_venda": _to_float(produto.get("preco")),
+                "preco_custo": _to_float(fornecedor.get("precoCusto")),
+                "categoria_id": _to_int(categoria.get("id")),
+                "categoria_descricao": categoria.get("descricao"),
+            })
 
+        upsert_produtos(self.db, rows)
+        self.stats["produtos"] += len(rows)
         logger.info("Etapa Produtos concluída: %d novos", self.stats["produtos"])
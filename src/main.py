@@ -2,13 +2,20 @@ import logging
 from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 
-from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from src.auth.oauth import exchange_authorization_code
 from src.config import get_settings
-from src.db.database import Base, engine, get_db
-from src.db.repository import get_last_successful_run, get_oauth_token
+from src.db.database import SessionLocal, get_db, init_schema
+from src.db.repository import (
+    create_etl_run,
+    fail_stale_etl_runs,
+    get_last_successful_run,
+    get_oauth_token,
+    has_running_etl,
+)
 from src.etl.pipeline import Pipeline
 
 settings = get_settings()
@@ -22,9 +29,15 @@ logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info("Iniciando aplicação — criando tabelas...")
-    Base.metadata.create_all(bind=engine)
-    logger.info("Tabelas criadas. Aplicação pronta.")
+    logger.info("Iniciando aplicação — verificando schema...")
+    init_schema()
+    # Execuções órfãs de um processo morto não podem travar o /run
+    db = SessionLocal()
+    try:
+        fail_stale_etl_runs(db)
+    finally:
+        db.close()
+    logger.info("Schema pronto. Aplicação pronta.")
     yield
     logger.info("Encerrando aplicação.")
 
@@ -73,26 +86,82 @@ def status(db: Session = Depends(get_db)):
 # ── Run pipeline ─────────────────────────────────────────────────────────────
 
 
+def _agendar_run(db: Session) -> int:
+    """Cria o registro da execução, recusando se já houver uma em andamento.
+
+    Execuções sobrepostas escreveriam nas mesmas tabelas e disputariam o
+    client compartilhado; o registro running em etl_controle serve de
+    trava (vale também entre workers, já que fica no banco). Órfãs velhas
+    são limpas antes para não travarem o índice único parcial.
+    """
+    fail_stale_etl_runs(db)
+    if has_running_etl(db):
+        raise HTTPException(
+            status_code=409,
+            detail="Já existe uma execução em andamento. Consulte /status.",
+        )
+    try:
+        return create_etl_run(db, datetime.now(timezone.utc).date())
+    except IntegrityError:
+        # Corrida: outro POST criou a run entre a checagem e o INSERT — o
+        # índice único parcial de status=running barrou a segunda
+        db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail="Já existe uma execução em andamento. Consulte /status.",
+        )
+
+
+def _executar_pipeline(
+    run_id: int,
+    data_inicio: str | None,
+    data_fim: str | None,
+    full: bool = False,
+) -> None:
+    """Corpo da tarefa em background — abre a própria sessão.
+
+    A sessão injetada no endpoint é fechada pelo get_db assim que a
+    resposta sai, antes de a tarefa rodar.
+    """
+    db = SessionLocal()
+    try:
+        pipeline = Pipeline(db)
+        if full:
+            pipeline.run_full(data_inicio, data_fim, run_id=run_id)
+        else:
+            pipeline.run(data_inicio=data_inicio, data_fim=data_fim, run_id=run_id)
+    finally:
+        db.close()
+
+
 @app.post("/run")
 def run_pipeline(
+    background_tasks: BackgroundTasks,
     data_inicio: str | None = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
     data_fim: str | None = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
     db: Session = Depends(get_db),
 ):
-    pipeline = Pipeline(db)
-    return pipeline.run(data_inicio=data_inicio, data_fim=data_fim)
+    # O run pode levar minutos: cria o registro já, devolve o id e deixa
+    # a extração para depois da resposta. /status acompanha o andamento.
+    run_id = _agendar_run(db)
+    background_tasks.add_task(_executar_pipeline, run_id, data_inicio, data_fim)
+    return {"status": "scheduled", "run_id": run_id}
 
 
 @app.post("/run/full")
 def run_full_pipeline(
+    background_tasks: BackgroundTasks,
     data_inicio: str = Query(..., pattern=r"^\d{4}-\d{2}-\d{2}$"),
     data_fim: str | None = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
     db: Session = Depends(get_db),
 ):
     if not data_fim:
         data_fim = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    pipeline = Pipeline(db)
-    return pipeline.run_full(data_inicio=data_inicio, data_fim=data_fim)
+    run_id = _agendar_run(db)
+    background_tasks.add_task(
+        _executar_pipeline, run_id, data_inicio, data_fim, full=True
+    )
+    return {"status": "scheduled", "run_id": run_id}
 
 
 # ── Auth ─────────────────────────────────────────────────────────────────────